@@ -1,12 +1,49 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./sql_app.db"
+SYNC_DATABASE_URL = "sqlite:///./sql_app.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+# Pool sizing: the default (5 + 10 overflow) exhausts under bursty load
+# while requests wait on the Gemini API with a connection checked out
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=3600,
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: attribute access after commit must not trigger
+# implicit IO on an AsyncSession (raises MissingGreenlet otherwise)
+SessionLocal = async_sessionmaker(
+    autocommit=False, autoflush=False, bind=engine, expire_on_commit=False
+)
+
+# Sync engine kept for startup-time DDL (create_all + lightweight migrations)
+sync_engine = create_engine(
+    SYNC_DATABASE_URL, connect_args={"check_same_thread": False}
+)
+
+# Per-connection SQLite tuning:
+# - WAL lets readers proceed while a writer commits, instead of the default
+#   journal mode serializing /chat writes against /questions reads
+# - synchronous=NORMAL drops the per-commit fsync to one per WAL checkpoint
+# - temp_store/mmap_size/cache_size keep sorts and hot pages in memory
+# - foreign_keys backs the ON DELETE CASCADE declarations on the models
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+event.listen(engine.sync_engine, "connect", _set_sqlite_pragma)
+event.listen(sync_engine, "connect", _set_sqlite_pragma)
 
 Base = declarative_base()
@@ -1,11 +1,28 @@
+import asyncio
+import fcntl
 import os
 import datetime
+import hashlib
+import json
+import math
+import pickle
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from google import genai
+from google.genai import types as genai_types
 from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+import httpx
+import orjson
+import redis.asyncio as aioredis
+from sqlalchemy import bindparam, delete, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 import models, database
 
 load_dotenv()
@@ -15,6 +32,454 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
 MODEL_NAME = 'gemini-2.5-flash'
 
+# Optional Redis for the chat-history window: survives restarts and is shared
+# across uvicorn workers. Same guard style as GEMINI_API_KEY — without
+# REDIS_URL the in-process window below keeps working (single-worker only).
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+# How many recent student chat messages the lecturer insight prompt may include
+INSIGHT_LOG_LIMIT = 500
+
+# Static parts of the lecturer insight prompt, hoisted so each request only
+# joins the dynamic snippets (logs, forum, query) between constant strings
+# instead of re-materializing the whole template
+_INSIGHT_PROMPT_HEAD = """
+    You are a university lecturer's intelligent assistant "Class AI" for Insight Analysis.
+
+    Your goal is to help the lecturer understand how students are doing based on two data sources:
+    1. Student Chat Logs (Private 1:1 sessions with AI)
+    2. Class Forum (Public questions posted by students)
+
+    [PRIVACY]: Do NOT quote specific messages or IDs unless necessary for context.
+    Summarize trends, confusion points, and suggest actions.
+    Answer in Japanese.
+
+    === Class Data Sources ===
+
+    [Source A: Student Chat Logs]
+    """
+
+_INSIGHT_PROMPT_MID = """
+
+    [Source B: Forum Questions]
+    """
+
+_INSIGHT_PROMPT_TAIL = """
+
+    ==========================
+    \n\nLecturer Query: """
+
+# Static part of the student-chat prompt. Passed as a real system instruction
+# (not re-sent inside every user turn), so the provider can cache it; only the
+# small forum snippet + query travel with each message.
+STUDENT_SYSTEM_INSTRUCTION = """
+You are Q-Chat AI, a helpful teaching assistant.
+Each user query comes with the current content of the class forum (questions from other students).
+Use it to inform your answers if relevant (e.g., "someone else asked this...").
+If the user asks about the forum, refer to that data.
+"""
+
+_STUDENT_CHAT_CONFIG = genai_types.GenerateContentConfig(
+    system_instruction=STUDENT_SYSTEM_INSTRUCTION
+)
+
+# Exact-match LLM response cache. Repeated identical prompts (same history +
+# forum context + message) skip the Gemini call entirely. In-process since the
+# prototype runs a single worker; entries expire so answers don't go stale.
+_LLM_CACHE_TTL = 300  # seconds
+_LLM_CACHE_MAX = 256
+_llm_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+def _llm_cache_key(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def _llm_cache_get(key: str) -> str | None:
+    entry = _llm_cache.get(key)
+    if entry is None:
+        return None
+    ts, text = entry
+    if time.monotonic() - ts > _LLM_CACHE_TTL:
+        del _llm_cache[key]
+        return None
+    _llm_cache.move_to_end(key)
+    return text
+
+def _llm_cache_put(key: str, text: str) -> None:
+    _llm_cache[key] = (time.monotonic(), text)
+    _llm_cache.move_to_end(key)
+    while len(_llm_cache) > _LLM_CACHE_MAX:
+        _llm_cache.popitem(last=False)
+
+# Version counter for the student chat logs, bumped on every persisted turn.
+# The lecturer-insight cache keys on (query, logs version, forum version)
+# instead of the rendered prompt, so a dashboard refresh skips the log
+# aggregation queries as well as the Gemini call while the data is unchanged.
+_logs_version = 0
+
+# Memo of the aggregated student-log text, valid for one logs version.
+# Consecutive insight queries with no intervening chat turns reuse the
+# rendered text instead of re-running the GROUP_CONCAT aggregation.
+_student_logs_memo: tuple[int, str] | None = None
+
+def _insight_cache_key(session_id: str, query: str) -> str:
+    return _llm_cache_key(
+        "insight", MODEL_NAME, session_id, query, str(_logs_version), str(_forum_version)
+    )
+
+# Short-term chat memory: a per-session sliding window of the most recent
+# messages, so the hot /chat path doesn't hit the DB for history every turn.
+# The DB stays the durable store and rehydrates the window on cold start.
+# With REDIS_URL set, the window lives in a Redis list (O(1) RPUSH appends,
+# LRANGE reads, trimmed and expiring) shared across workers; otherwise it is
+# a per-process deque.
+_HISTORY_WINDOW = 40
+_HISTORY_TTL = 24 * 3600  # seconds; idle sessions drop out of Redis
+# How many recent messages each Gemini turn sees; older ones are folded into
+# the session's rolling summary (see _refresh_session_summary)
+_PROMPT_WINDOW = 20
+_history_cache: dict[str, deque] = {}
+
+def _history_key(session_id: str) -> str:
+    return f"chat:{session_id}"
+
+async def _history_from_db(db: "AsyncSession", session_id: str) -> list[dict]:
+    rows = (
+        await db.execute(
+            select(models.ChatMessage)
+            .where(models.ChatMessage.session_id == session_id)
+            .order_by(models.ChatMessage.id.desc())
+            .limit(_HISTORY_WINDOW)
+        )
+    ).scalars().all()
+    return [{"role": m.role, "content": m.content} for m in reversed(rows)]
+
+async def _get_recent_history(db: "AsyncSession", session_id: str) -> list[dict]:
+    if redis_client is not None:
+        key = _history_key(session_id)
+        try:
+            raw = await redis_client.lrange(key, -_HISTORY_WINDOW, -1)
+        except Exception:
+            raw = None  # Redis unavailable: fall through to the local window
+        if raw:
+            return [json.loads(m) for m in raw]
+        if raw is not None:
+            # Cold key: rehydrate from the DB and backfill Redis
+            msgs = await _history_from_db(db, session_id)
+            if msgs:
+                try:
+                    pipe = redis_client.pipeline()
+                    pipe.rpush(key, *(json.dumps(m) for m in msgs))
+                    pipe.ltrim(key, -_HISTORY_WINDOW, -1)
+                    pipe.expire(key, _HISTORY_TTL)
+                    await pipe.execute()
+                except Exception:
+                    pass
+            return msgs
+
+    window = _history_cache.get(session_id)
+    if window is None:
+        window = deque(await _history_from_db(db, session_id), maxlen=_HISTORY_WINDOW)
+        _history_cache[session_id] = window
+    return list(window)
+
+async def _history_append(session_id: str, role: str, content: str) -> None:
+    if redis_client is not None:
+        try:
+            key = _history_key(session_id)
+            pipe = redis_client.pipeline()
+            pipe.rpush(key, json.dumps({"role": role, "content": content}))
+            pipe.ltrim(key, -_HISTORY_WINDOW, -1)
+            pipe.expire(key, _HISTORY_TTL)
+            await pipe.execute()
+            return
+        except Exception:
+            pass  # fall back to the local window; DB persistence still happens
+    window = _history_cache.get(session_id)
+    if window is not None:
+        window.append({"role": role, "content": content})
+
+# Gemini request coalescer: under bursty traffic, pending calls are drained
+# from a queue in small batches (waiting up to a few ms for company) and
+# dispatched concurrently under one bound, instead of each request firing an
+# independent call the moment it arrives. Workers run the blocking SDK call in
+# a thread so the event loop keeps serving other requests.
+_GEMINI_BATCH_MAX = int(os.getenv("GEMINI_BATCH_MAX", "8"))
+# seconds to wait for more work before dispatching
+_GEMINI_BATCH_WINDOW = float(os.getenv("GEMINI_BATCH_WINDOW", "0.02"))
+_GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+_gemini_queue: asyncio.Queue = asyncio.Queue()
+_gemini_semaphore = asyncio.Semaphore(_GEMINI_MAX_CONCURRENCY)
+_gemini_worker_task: asyncio.Task | None = None
+
+async def _run_gemini_job(fut: asyncio.Future, fn) -> None:
+    async with _gemini_semaphore:
+        try:
+            result = await asyncio.to_thread(fn)
+            if not fut.cancelled():
+                fut.set_result(result)
+        except Exception as e:
+            if not fut.cancelled():
+                fut.set_exception(e)
+
+async def _gemini_worker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _gemini_queue.get()]
+        deadline = loop.time() + _GEMINI_BATCH_WINDOW
+        while len(batch) < _GEMINI_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_gemini_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        for fut, fn in batch:
+            loop.create_task(_run_gemini_job(fut, fn))
+
+def _ensure_gemini_worker() -> None:
+    global _gemini_worker_task
+    if _gemini_worker_task is None or _gemini_worker_task.done():
+        _gemini_worker_task = asyncio.get_running_loop().create_task(_gemini_worker())
+
+async def _gemini_call(fn):
+    """Run a blocking Gemini SDK call through the coalescer and await its result."""
+    _ensure_gemini_worker()
+    fut = asyncio.get_running_loop().create_future()
+    await _gemini_queue.put((fut, fn))
+    return await fut
+
+async def _stream_in_thread(iterator):
+    """Drain a blocking iterator (e.g. send_message_stream) from a worker
+    thread, yielding each item to the event loop as it arrives."""
+    sentinel = object()
+    it = iter(iterator)
+    while True:
+        chunk = await asyncio.to_thread(next, it, sentinel)
+        if chunk is sentinel:
+            break
+        yield chunk
+
+# Per-session Gemini Chat objects so consecutive turns reuse one SDK chat
+# (and its accumulated history) instead of recreating it from scratch.
+# TTL'd LRU, same shape as the response cache above.
+_CHAT_CACHE_TTL = 1800  # seconds
+_CHAT_CACHE_MAX = 1024
+_chat_cache: OrderedDict[str, tuple[float, object, str | None]] = OrderedDict()
+
+def _chat_cache_get(session_id: str):
+    entry = _chat_cache.get(session_id)
+    if entry is None:
+        return None
+    ts, chat, ctx_key = entry
+    if time.monotonic() - ts > _CHAT_CACHE_TTL:
+        del _chat_cache[session_id]
+        return None
+    _chat_cache.move_to_end(session_id)
+    return chat, ctx_key
+
+def _chat_cache_put(session_id: str, chat, ctx_key: str | None = None) -> None:
+    # A warm chat gains two messages per send with no truncation, and the
+    # re-put refreshes its TTL every turn — without a bound, tokens per call
+    # grow unbounded for exactly the long sessions the window exists for.
+    # Once it outgrows the window by a full window's worth of warm turns,
+    # drop it; the next turn re-hydrates through the summary + sliding-window
+    # path with bounded history.
+    try:
+        history_len = len(chat.get_history())
+    except Exception:
+        history_len = 0  # SDK object without readable history: keep caching
+    if history_len > 2 * _PROMPT_WINDOW:
+        _chat_cache.pop(session_id, None)
+        return
+    _chat_cache[session_id] = (time.monotonic(), chat, ctx_key)
+    _chat_cache.move_to_end(session_id)
+    while len(_chat_cache) > _CHAT_CACHE_MAX:
+        _chat_cache.popitem(last=False)
+
+# One lock per session: the SDK Chat object mutates its internal history on
+# send, so two in-flight turns for the same session must not interleave.
+# Different sessions still run concurrently.
+_chat_locks: dict[str, asyncio.Lock] = {}
+
+def _chat_lock(session_id: str) -> asyncio.Lock:
+    lock = _chat_locks.get(session_id)
+    if lock is None:
+        lock = _chat_locks.setdefault(session_id, asyncio.Lock())
+    return lock
+
+# Explicit Gemini context cache for the forum block. When the rendered forum
+# context is unchanged, its tokens are uploaded once and referenced by handle
+# in chats.create instead of travelling inline with every turn. Best-effort:
+# small prefixes fall below the API's cacheable minimum, and a None handle
+# means "send it inline as before".
+_GEMINI_CTX_TTL = _CHAT_CACHE_TTL  # server-side ttl; outlives any cached chat
+_gemini_ctx_cache: dict[str, tuple[float, object]] = {}
+
+def _forum_ctx_key(forum_context: str) -> str:
+    return hashlib.sha256(forum_context.encode()).hexdigest()
+
+async def _get_forum_cache_handle(forum_context: str):
+    key = _forum_ctx_key(forum_context)
+    entry = _gemini_ctx_cache.get(key)
+    if entry is not None:
+        ts, handle = entry
+        if time.monotonic() - ts < _GEMINI_CTX_TTL - 60:
+            return handle
+        del _gemini_ctx_cache[key]
+    try:
+        handle = await asyncio.to_thread(
+            client.caches.create,
+            model=MODEL_NAME,
+            config=genai_types.CreateCachedContentConfig(
+                system_instruction=STUDENT_SYSTEM_INSTRUCTION,
+                contents=[{
+                    "role": "user",
+                    "parts": [{"text": f"=== Forum Data ===\n{forum_context}\n=================="}],
+                }],
+                ttl=f"{_GEMINI_CTX_TTL}s",
+            ),
+        )
+    except Exception:
+        handle = None  # prefix below the cacheable minimum, or API hiccup
+    _gemini_ctx_cache[key] = (time.monotonic(), handle)
+    return handle
+
+# Semantic response cache: students re-ask near-identical questions, and those
+# can reuse the previous answer without a generation call. Messages are
+# embedded via the Gemini embedding endpoint and matched with a linear cosine
+# scan over a small per-session window — plenty at prototype scale, and
+# namespacing by session avoids leaking one student's answers to another.
+# Best-effort like the context cache: an embedding failure just skips the layer.
+_EMBED_MODEL = "gemini-embedding-001"
+_SEM_CACHE_TTL = 3600  # seconds
+_SEM_CACHE_MAX = 64  # entries kept per session
+_SEM_THRESHOLD = 0.9  # cosine similarity needed for a hit
+_sem_cache: dict[str, deque] = {}
+
+async def _embed_message(text: str) -> list[float] | None:
+    try:
+        result = await asyncio.to_thread(
+            client.models.embed_content, model=_EMBED_MODEL, contents=text
+        )
+        return _normalize(result.embeddings[0].values)
+    except Exception:
+        return None
+
+def _normalize(vec) -> list[float] | None:
+    norm = math.sqrt(sum(v * v for v in vec))
+    if not norm:
+        return None
+    return [v / norm for v in vec]
+
+def _sem_cache_lookup(session_id: str, vector: list[float]) -> str | None:
+    entries = _sem_cache.get(session_id)
+    if not entries:
+        return None
+    now = time.monotonic()
+    best_text = None
+    best_sim = _SEM_THRESHOLD
+    for ts, vec, text in entries:
+        if now - ts > _SEM_CACHE_TTL:
+            continue
+        sim = sum(a * b for a, b in zip(vector, vec))  # vectors are pre-normalized
+        if sim >= best_sim:
+            best_sim = sim
+            best_text = text
+    return best_text
+
+def _sem_cache_put(session_id: str, vector: list[float], text: str) -> None:
+    entries = _sem_cache.setdefault(session_id, deque(maxlen=_SEM_CACHE_MAX))
+    entries.append((time.monotonic(), vector, text))
+
+# Rendered forum-context cache, keyed by (limit, version). Mutations bump the
+# version rather than clearing, so an in-flight reader still resolves its own
+# key; stale versions age out through the LRU cap. The short TTL is a safety
+# net (e.g. direct DB edits).
+_FORUM_CTX_TTL = 60  # seconds
+_FORUM_CTX_MAX = 8
+_forum_version = 0
+_forum_ctx_cache: OrderedDict[tuple[int, int], tuple[float, str]] = OrderedDict()
+
+def _invalidate_forum_context() -> None:
+    global _forum_version
+    _forum_version += 1
+
+# Hot-path lookup statements built once at import. Reusing the same Select
+# object lets SQLAlchemy skip per-request cache-key construction; handlers
+# just bind parameters.
+_Q_BY_ID = select(models.Question).where(models.Question.id == bindparam("qid"))
+_USER_BY_NAME = select(models.User).where(models.User.username == bindparam("username"))
+_SESSION_BY_ID = select(models.ChatSession).where(models.ChatSession.session_id == bindparam("sid"))
+
+# Child tables whose foreign keys must carry ON DELETE CASCADE, in
+# parent-before-child order (the comment table must exist and be populated
+# before its reactions are copied)
+_CASCADE_FK_TABLES = {
+    "question_comments": "questions",
+    "question_reactions": "questions",
+    "comment_reactions": "question_comments",
+}
+
+# Pre-constraint databases can hold duplicate reactions (the baseline /react
+# handlers were unconstrained check-then-insert running in a threadpool);
+# the rebuilt tables carry UNIQUE constraints, so the copy must keep only the
+# earliest row per key or startup dies on the INSERT ... SELECT
+_REBUILD_DEDUP_KEYS = {
+    "question_reactions": ("question_id", "user_id"),
+    "comment_reactions": ("comment_id", "user_id"),
+}
+
+def _ensure_cascade_fks(engine) -> None:
+    """Rebuild child tables created before ON DELETE CASCADE was declared.
+
+    SQLite can't alter a foreign key in place, so this is the documented
+    rename-copy-drop dance. Runs on an autocommit connection so the
+    foreign_keys pragma (a no-op inside a transaction) can be lowered while
+    tables move; safe because every table that references a renamed one is
+    itself rebuilt from the current metadata.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        for table, parent in _CASCADE_FK_TABLES.items():
+            fks = conn.exec_driver_sql(f"PRAGMA foreign_key_list({table})").fetchall()
+            # Rebuild unless a cascading FK to the expected parent already
+            # exists (an earlier rename may have rewritten the reference to a
+            # *_old name, so the absence of a match also means rebuild)
+            if any(row[2] == parent and row[6] == "CASCADE" for row in fks):
+                continue
+            # Explicit transaction per table: rename, index drops, create,
+            # copy and drop land together or not at all — a failure must not
+            # strand rows in *_old on this autocommit connection
+            conn.exec_driver_sql("BEGIN")
+            try:
+                conn.exec_driver_sql(f"ALTER TABLE {table} RENAME TO {table}_old")
+                # RENAME keeps the old table's named indexes under their
+                # original names; drop them so the create below can claim them
+                for idx in conn.exec_driver_sql(f"PRAGMA index_list({table}_old)").fetchall():
+                    if idx[3] == "c":  # origin 'c' = CREATE INDEX (droppable)
+                        conn.exec_driver_sql(f'DROP INDEX "{idx[1]}"')
+                models.Base.metadata.tables[table].create(conn)
+                dedup_key = _REBUILD_DEDUP_KEYS.get(table)
+                if dedup_key:
+                    key_cols = ", ".join(dedup_key)
+                    conn.exec_driver_sql(
+                        f"DELETE FROM {table}_old WHERE id NOT IN "
+                        f"(SELECT MIN(id) FROM {table}_old GROUP BY {key_cols})"
+                    )
+                conn.exec_driver_sql(f"INSERT INTO {table} SELECT * FROM {table}_old")
+                conn.exec_driver_sql(f"DROP TABLE {table}_old")
+                conn.exec_driver_sql("COMMIT")
+            except Exception:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+        conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+
 # Lightweight schema migration (SQLite)
 def _ensure_questions_schema(engine) -> None:
     with engine.begin() as conn:
@@ -23,12 +488,83 @@ def _ensure_questions_schema(engine) -> None:
             conn.exec_driver_sql(
                 "ALTER TABLE questions ADD COLUMN resolved INTEGER NOT NULL DEFAULT 0"
             )
+        # tags was PickleType before becoming JSON; rewrite legacy pickled
+        # blobs as JSON text so the new column type can hydrate them
+        for qid, raw in conn.exec_driver_sql(
+            "SELECT id, tags FROM questions WHERE tags IS NOT NULL"
+        ).fetchall():
+            if not isinstance(raw, bytes):
+                continue  # already JSON text
+            try:
+                value = pickle.loads(raw)
+            except Exception:
+                value = []  # unreadable legacy blob; drop rather than crash reads
+            conn.exec_driver_sql(
+                "UPDATE questions SET tags = ? WHERE id = ?", (json.dumps(value), qid)
+            )
+        session_cols = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(chat_sessions)").fetchall()}
+        if "summary" not in session_cols:
+            conn.exec_driver_sql("ALTER TABLE chat_sessions ADD COLUMN summary TEXT")
+        if "summary_upto_id" not in session_cols:
+            conn.exec_driver_sql(
+                "ALTER TABLE chat_sessions ADD COLUMN summary_upto_id INTEGER NOT NULL DEFAULT 0"
+            )
+    _ensure_cascade_fks(engine)
+    with engine.begin() as conn:
+        # create_all skips existing tables, so add the hot-path indexes here for DBs
+        # created before they were declared on the models
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_chat_messages_session_id_id ON chat_messages (session_id, id)"
+        )
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_question_reactions_question_user ON question_reactions (question_id, user_id)"
+        )
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_comment_reactions_comment_user ON comment_reactions (comment_id, user_id)"
+        )
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_questions_created_at ON questions (created_at)"
+        )
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_question_reactions_qid_user_type ON question_reactions (question_id, user_id, reaction_type)"
+        )
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_question_comments_qid_created_id ON question_comments (question_id, created_at, id)"
+        )
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_comment_reactions_cid_user_type ON comment_reactions (comment_id, user_id, reaction_type)"
+        )
 
-# Initialize DB
-models.Base.metadata.create_all(bind=database.engine)
-_ensure_questions_schema(database.engine)
-
-app = FastAPI()
+def _init_db() -> None:
+    # DDL runs on the sync engine (the FK-rebuild migration needs an
+    # autocommit connection); request traffic uses the async one. The file
+    # lock serializes startup across uvicorn workers — without it create_all's
+    # existence checks race and a worker dies on "table already exists"
+    with open("sql_app.db.init.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        models.Base.metadata.create_all(bind=database.sync_engine)
+        _ensure_questions_schema(database.sync_engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Size the default executor for IO-bound Gemini work: every SDK call goes
+    # through asyncio.to_thread, and the stock pool (cpu_count + 4) is too
+    # small when many requests sit in multi-second LLM round-trips
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=32, thread_name_prefix="gemini")
+    )
+    # Run DDL once per process after the loop is up, in a worker thread —
+    # importing the module stays pure Python (cheap reloads, no sync DB IO
+    # on the event loop)
+    await asyncio.to_thread(_init_db)
+    yield
+    # Flush write-behind chat persistence so a clean shutdown loses no turns
+    if _write_worker_task is not None and not _write_worker_task.done():
+        await _write_queue.join()
+        _write_worker_task.cancel()
+
+# orjson serializes responses in C (incl. datetime), much faster than stdlib json
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # CORS config
 app.add_middleware(
@@ -40,12 +576,9 @@ app.add_middleware(
 )
 
 # Dependency
-def get_db():
-    db = database.SessionLocal()
-    try:
+async def get_db():
+    async with database.SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # Pydantic Models
 class ChatRequest(BaseModel):
@@ -76,7 +609,7 @@ class UserLogin(BaseModel):
 class UserResponse(BaseModel):
     id: int
     username: str
-    
+
     class Config:
         from_attributes = True
 
@@ -94,10 +627,18 @@ class QuestionResponse(BaseModel):
     reactions: dict[str, int]
     user_reaction: str | None = None
     comment_count: int = 0
-    
+
     class Config:
         from_attributes = True
 
+class BatchItem(BaseModel):
+    method: str = "GET"
+    path: str
+    body: dict | None = None
+
+class BatchRequest(BaseModel):
+    requests: list[BatchItem]
+
 class CommentCreate(BaseModel):
     author: str
     content: str
@@ -118,258 +659,722 @@ class CommentResponse(BaseModel):
     class Config:
         from_attributes = True
 
+# Static payload serialized once at import; the liveness route just hands
+# the bytes back instead of re-encoding the same dict per request
+_ROOT_RESPONSE = orjson.dumps({"Hello": "World", "Service": "Question Chat App (Persistent)"})
+
 @app.get("/")
 def read_root():
-    return {"Hello": "World", "Service": "Question Chat App (Persistent)"}
+    return Response(_ROOT_RESPONSE, media_type="application/json")
+
+_BATCH_MAX_REQUESTS = 20
+
+@app.post("/batch")
+async def batch(batch_req: BatchRequest):
+    """Run several independent API calls in one HTTP round trip.
+
+    Sub-requests are dispatched concurrently through the app itself (ASGI
+    in-process, no loopback sockets), so a batch costs max(sub-request)
+    instead of their sum. Results come back in request order as
+    {"status": ..., "body": ...}; callers sequence dependent calls across
+    batches themselves.
+    """
+    if len(batch_req.requests) > _BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"Batch too large (max {_BATCH_MAX_REQUESTS})")
+    if any(item.path.startswith("/batch") for item in batch_req.requests):
+        raise HTTPException(status_code=400, detail="Nested batch requests are not allowed")
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://batch") as c:
+        async def run(item: BatchItem):
+            resp = await c.request(item.method.upper(), item.path, json=item.body)
+            try:
+                body = resp.json()
+            except ValueError:
+                body = resp.text
+            return {"status": resp.status_code, "body": body}
+
+        responses = await asyncio.gather(*(run(item) for item in batch_req.requests))
+    return {"responses": list(responses)}
+
+async def _upsert_user(db: AsyncSession, username: str):
+    """Get-or-create a user in one round trip via UPSERT.
+
+    The no-op DO UPDATE makes RETURNING yield the row whether it already
+    existed or not; callers commit.
+    """
+    stmt = (
+        sqlite_insert(models.User)
+        .values(username=username)
+        .on_conflict_do_update(index_elements=["username"], set_={"username": username})
+        .returning(models.User.id, models.User.username)
+    )
+    return (await db.execute(stmt)).one()
 
 @app.post("/login", response_model=UserResponse)
-def login(login_req: UserLogin, db: Session = Depends(get_db)):
+async def login(login_req: UserLogin, db: AsyncSession = Depends(get_db)):
     username = login_req.username.strip()
     if not username:
         raise HTTPException(status_code=400, detail="Username cannot be empty")
-        
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
-        user = models.User(username=username)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    return user
+
+    row = await _upsert_user(db, username)
+    await db.commit()
+    return {"id": row.id, "username": row.username}
 
 @app.get("/chat/history")
-def get_chat_history(session_id: str, db: Session = Depends(get_db)):
-    return db.query(models.ChatMessage).filter(models.ChatMessage.session_id == session_id).order_by(models.ChatMessage.id).all()
+async def get_chat_history(
+    session_id: str,
+    before_id: int | None = None,
+    limit: int | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    # Plain column rows — no ORM instance construction just to serialize them.
+    # before_id/limit allow clients to page backwards through long histories.
+    stmt = (
+        select(models.ChatMessage.id, models.ChatMessage.session_id,
+               models.ChatMessage.role, models.ChatMessage.content,
+               models.ChatMessage.timestamp)
+        .where(models.ChatMessage.session_id == session_id)
+    )
+    if before_id is not None:
+        stmt = stmt.where(models.ChatMessage.id < before_id)
+    if limit is not None:
+        # The page is the `limit` messages immediately preceding the cursor:
+        # take them newest-first, then restore chronological order
+        rows = (await db.execute(stmt.order_by(models.ChatMessage.id.desc()).limit(limit))).all()
+        rows = list(reversed(rows))
+    else:
+        rows = (await db.execute(stmt.order_by(models.ChatMessage.id))).all()
+    return [dict(r._mapping) for r in rows]
+
+async def _build_chat_prompt(db: AsyncSession, session_id: str, message: str) -> tuple[list[dict], str, str]:
+    """Shared prompt prep for /chat and /chat/stream.
+
+    Ensures the ChatSession row exists (staged on `db`, committed by the
+    caller), and returns (gemini_history, chat_input, forum_context) for this
+    turn.
+    """
+    # Ensure the session row exists — race-free via do-nothing UPSERT, like
+    # _upsert_user: concurrent first turns must not collide on the insert.
+    # Default role to student for now since the UI generates the ID.
+    await db.execute(
+        sqlite_insert(models.ChatSession)
+        .values(session_id=session_id, role="student")
+        .on_conflict_do_nothing(index_elements=["session_id"])
+    )
+    # Re-fetch for the rolling summary (pre-existing sessions carry one)
+    db_session = (
+        await db.execute(_SESSION_BY_ID, {"sid": session_id})
+    ).scalars().first()
+
+    # Retrieve History from the in-process sliding window (no DB read on the
+    # hot path once the window is warm); keep the last 20 messages for Gemini
+    history_msgs = (await _get_recent_history(db, session_id))[-_PROMPT_WINDOW:]
+
+    # Retrieve Forum Context — only this dynamic snippet travels with the turn;
+    # the static instructions live in _STUDENT_CHAT_CONFIG's system_instruction
+    forum_context = await get_forum_context(db)
+
+    chat_input = f"=== Forum Data ===\n{forum_context}\n==================\n\nUser Query: {message}"
+
+    # `history_msgs` holds only prior turns; the current message travels
+    # inside `chat_input`.
+    gemini_history = [
+        {"role": "user" if msg["role"] == "user" else "model", "parts": [{"text": msg["content"]}]}
+        for msg in history_msgs
+    ]
+    # Long sessions: turns that slid out of the window survive as a rolling
+    # summary, injected as a synthetic opening exchange
+    if db_session is not None and getattr(db_session, "summary", None):
+        gemini_history = [
+            {"role": "user", "parts": [{"text": f"(Summary of our conversation so far)\n{db_session.summary}"}]},
+            {"role": "model", "parts": [{"text": "Understood. I'll keep that context in mind."}]},
+        ] + gemini_history
+    return gemini_history, chat_input, forum_context
+
+async def _persist_chat_turn(session_id: str, user_text: str, model_text: str) -> None:
+    """Write a completed turn (user message + model reply) in one transaction.
+
+    Runs outside the request path, so it takes a fresh session — the
+    request-scoped one is torn down with the response.
+    """
+    global _logs_version
+    async with database.SessionLocal() as s:
+        s.add(models.ChatMessage(session_id=session_id, role="user", content=user_text))
+        s.add(models.ChatMessage(session_id=session_id, role="model", content=model_text))
+        await s.commit()
+    _logs_version += 1
+    _schedule_summary_refresh(session_id)
+
+# Write-behind persistence for completed chat turns: handlers enqueue and
+# return, and a single worker drains the queue off the request path (same
+# lazy-worker shape as the Gemini coalescer). Bounded so a stalled DB
+# degrades to dropping persistence instead of growing without limit — the
+# history window still holds the turn, and lifespan drains the queue on
+# shutdown so a clean exit loses nothing.
+_WRITE_QUEUE_MAX = 1000
+_write_queue: asyncio.Queue = asyncio.Queue(maxsize=_WRITE_QUEUE_MAX)
+_write_worker_task: asyncio.Task | None = None
+
+async def _write_worker() -> None:
+    while True:
+        session_id, user_text, model_text = await _write_queue.get()
+        try:
+            await _persist_chat_turn(session_id, user_text, model_text)
+        except Exception:
+            import traceback
+            traceback.print_exc()  # lose one turn, keep draining
+        finally:
+            _write_queue.task_done()
+
+def _enqueue_chat_turn(session_id: str, user_text: str, model_text: str) -> None:
+    global _write_worker_task
+    if _write_worker_task is None or _write_worker_task.done():
+        _write_worker_task = asyncio.get_running_loop().create_task(_write_worker())
+    try:
+        _write_queue.put_nowait((session_id, user_text, model_text))
+    except asyncio.QueueFull:
+        print(f"chat write queue full; dropping persistence for session {session_id}")
+
+# Rolling-summary maintenance: once enough turns have slid past the prompt
+# window, a background task folds them into ChatSession.summary so long
+# sessions keep bounded input tokens without losing early context. Best
+# effort — a failed refresh just means the next one covers more messages.
+_SUMMARY_MIN_BATCH = 6  # messages beyond the window before a refresh pays off
+_summary_tasks: dict[str, asyncio.Task] = {}
+
+def _schedule_summary_refresh(session_id: str) -> None:
+    if client is None:
+        return
+    task = _summary_tasks.get(session_id)
+    if task is not None and not task.done():
+        return  # a refresh for this session is already in flight
+    _summary_tasks[session_id] = asyncio.get_running_loop().create_task(
+        _refresh_session_summary(session_id)
+    )
+
+async def _refresh_session_summary(session_id: str) -> None:
+    try:
+        async with database.SessionLocal() as s:
+            sess = (
+                await s.execute(_SESSION_BY_ID, {"sid": session_id})
+            ).scalars().first()
+            if sess is None:
+                return
+            # Newest message that has left the prompt window
+            window_floor = (
+                await s.execute(
+                    select(models.ChatMessage.id)
+                    .where(models.ChatMessage.session_id == session_id)
+                    .order_by(models.ChatMessage.id.desc())
+                    .offset(_PROMPT_WINDOW)
+                    .limit(1)
+                )
+            ).scalar()
+            upto = sess.summary_upto_id or 0
+            if window_floor is None or window_floor <= upto:
+                return  # nothing new outside the window
+            rows = (
+                await s.execute(
+                    select(models.ChatMessage.role, models.ChatMessage.content)
+                    .where(models.ChatMessage.session_id == session_id)
+                    .where(models.ChatMessage.id > upto)
+                    .where(models.ChatMessage.id <= window_floor)
+                    .order_by(models.ChatMessage.id)
+                )
+            ).all()
+            prior_summary = sess.summary
+        if len(rows) < _SUMMARY_MIN_BATCH:
+            return  # batch evicted turns; don't burn a Gemini call per message
+        transcript = "\n".join(f"{role}: {content}" for role, content in rows)
+        prompt = (
+            "You maintain a running summary of a student's tutoring chat.\n"
+            + (f"Current summary:\n{prior_summary}\n\n" if prior_summary else "")
+            + f"New messages since that summary:\n{transcript}\n\n"
+            "Write an updated summary (same language as the conversation, "
+            "under 200 words) covering the topics discussed, what the student "
+            "struggled with, and anything agreed or resolved. Output only the summary."
+        )
+        response = await _gemini_call(
+            lambda: client.models.generate_content(model=MODEL_NAME, contents=prompt)
+        )
+        new_summary = response.text
+        if not new_summary:
+            return
+        async with database.SessionLocal() as s:
+            sess = (
+                await s.execute(_SESSION_BY_ID, {"sid": session_id})
+            ).scalars().first()
+            if sess is None:
+                return
+            sess.summary = new_summary.strip()
+            sess.summary_upto_id = window_floor
+            await s.commit()
+    except Exception:
+        import traceback
+        traceback.print_exc()
 
 @app.post("/chat")
-async def chat_with_ai(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_with_ai(request: ChatRequest, db: AsyncSession = Depends(get_db)):
     if client is None:
         raise HTTPException(status_code=503, detail="GEMINI_API_KEY not set")
 
     session_id = request.session_id
-    
-    # Check if session exists, create if not
-    db_session = db.query(models.ChatSession).filter(models.ChatSession.session_id == session_id).first()
-    if not db_session:
-        db_session = models.ChatSession(session_id=session_id, role="student") # Default to student for now since UI generates ID
-        db.add(db_session)
-        db.commit()
-
-    # 1. Save User Message
-    user_msg = models.ChatMessage(session_id=session_id, role="user", content=request.message)
-    db.add(user_msg)
-    db.commit()
-
-    # 2. Retrieve History
-    # Limit history to last 10 turns? Or full history. Let's do last 20 messages.
-    history_msgs = db.query(models.ChatMessage).filter(models.ChatMessage.session_id == session_id).order_by(models.ChatMessage.id).all()
-    
-    # 3. Retrieve Forum Context
-    forum_context = get_forum_context(db)
-
-    # Format for Gemini
-    gemini_history = []
-    
-    # Add System/Context Instruction as first part?
-    # Or just prepend to history.
-    system_instruction = f"""
-    You are Q-Chat AI, a helpful teaching assistant.
-    Below is the current content of the class forum (questions from other students).
-    Use this to inform your answers if relevant (e.g., "someone else asked this...").
-    If the user asks about the forum, refer to this data.
-    
-    === Forum Data ===
-    {forum_context}
-    ==================
-    """
-    
-    # We can use client.chats.create(..., system_instruction=...) if supported by library version, 
-    # or just prepend as a user message that the model "acknowledged" implicitly.
-    # Let's try prepending it to the chat history as a "system" context.
-    # But for a stateful chat, we might just want to inject it into the prompt if use SDK chat.
-    
-    # Simple approach: Rebuild history every time with System Prompt at start.
-    
-    # Note: genai SDK `history` is list of contents.
-    # We will treat the forum context as the "system instruction" hidden in the first turn or config.
-    # 'gemini-1.5-flash' and '2.0' support system_instruction arg in client.models.generate_content
-    # but for `chats.create`, it is passed in `config` or as `history`.
-    
-    # Let's try passing it as a system instruction via the model config if possible, 
-    # OR just prepending it to the user's current message if we want it fresh every time.
-    # Prepending to current message is safest for "fresh" context.
-    
-    chat_input = f"{system_instruction}\n\nUser Query: {request.message}"
-
-    # Reconstruct history EXCLUDING the latest message we just saved (which is request.message)
-    # because we are sending `chat_input` which contains request.message.
-    # Wait, `history_msgs` includes the `user_msg` we just saved at line 110?
-    # Yes, we did db.add and commit.
-    
-    # So `history_msgs` has [Old1, Old2, ... NewUserMsg].
-    # We want `gemini_history` to be [Old1, Old2, ...].
-    # And we send `chat_input` (Context + NewUserMsg).
-    
-    for msg in history_msgs[:-1]:
-        gemini_history.append({"role": "user" if msg.role == "user" else "model", "parts": [{"text": msg.content}]})
+    gemini_history, chat_input, forum_context = await _build_chat_prompt(db, session_id, request.message)
+    await db.commit()  # persist the session row if it was just created
+
+    # All DB work for this request is done (persistence happens on a fresh
+    # session in the background task) — release the connection now instead of
+    # holding a pool slot for the multi-second Gemini wait
+    await db.close()
 
     try:
-        # Note: If we really want "system instruction" behavior that persists, 
-        # we can put it in `client.chats.create(..., config=...)`.
-        # But injecting into the *current* turn is also fine.
-        
-        chat = client.chats.create(model=MODEL_NAME, history=gemini_history)
-        
-        # Send the context + message
-        # But wait, if we send `chat_input`, the model will see:
-        # User: [Context + Message]
-        # Model: Response
-        # Next time we load history, we load `ChatMessage` which is just `Message`.
-        # So the context is transient for *this generation*, which is good (keeps history clean).
-        
-        response = chat.send_message(chat_input)
-        
-        # 3. Save Model Response
-        model_msg = models.ChatMessage(session_id=session_id, role="model", content=response.text)
-        db.add(model_msg)
-        db.commit()
-        
-        return {"response": response.text}
+        generated = False
+
+        # Exact cache hit: identical prompt state, reuse the previous answer
+        cache_key = _llm_cache_key(MODEL_NAME, json.dumps(gemini_history), chat_input)
+        response_text = _llm_cache_get(cache_key)
+
+        # Semantic layer: a near-duplicate of an earlier question in this
+        # session reuses its answer
+        vector = None
+        if response_text is None:
+            vector = await _embed_message(request.message)
+            if vector is not None:
+                response_text = _sem_cache_lookup(session_id, vector)
+
+        if response_text is None:
+            # Serialize turns per session: the Chat object's internal history
+            # must not see two interleaved sends
+            async with _chat_lock(session_id):
+                # Re-check after acquiring — an identical concurrent turn may
+                # have answered while this one waited
+                response_text = _llm_cache_get(cache_key)
+                if response_text is None:
+                    current_ctx = _forum_ctx_key(forum_context)
+                    # Reuse the session's chat object when warm; hydrate it
+                    # from the history window only on a cold start
+                    cached_chat = _chat_cache_get(session_id)
+                    if cached_chat is not None:
+                        chat, chat_ctx = cached_chat
+                    else:
+                        # New chat: try to pin the forum block server-side so
+                        # its tokens aren't re-sent with every turn
+                        handle = await _get_forum_cache_handle(forum_context)
+                        if handle is not None:
+                            chat_ctx = current_ctx
+                            chat = client.chats.create(
+                                model=MODEL_NAME,
+                                history=gemini_history,
+                                config=genai_types.GenerateContentConfig(cached_content=handle.name),
+                            )
+                        else:
+                            chat_ctx = None
+                            chat = client.chats.create(
+                                model=MODEL_NAME, history=gemini_history, config=_STUDENT_CHAT_CONFIG
+                            )
+
+                    # A chat pinned to the current forum snapshot gets just
+                    # the query; otherwise the forum block travels inline for
+                    # this generation, which keeps the history clean.
+                    if chat_ctx is not None and chat_ctx == current_ctx:
+                        send_text = f"User Query: {request.message}"
+                    else:
+                        send_text = chat_input
+
+                    response = await _gemini_call(lambda: chat.send_message(send_text))
+                    response_text = response.text
+                    generated = True
+                    _llm_cache_put(cache_key, response_text)
+                    if vector is not None:
+                        _sem_cache_put(session_id, vector, response_text)
+                    _chat_cache_put(session_id, chat, chat_ctx)
+
+        if not generated:
+            # A cache-served turn never reached the cached Chat, so its
+            # internal history is now missing this exchange; drop it and let
+            # the next real generation re-hydrate from the history window
+            # (which does include the turn)
+            _chat_cache.pop(session_id, None)
+
+        # Persist the turn after the response goes out — the reply reaches the
+        # student without waiting for the commit
+        _enqueue_chat_turn(session_id, request.message, response_text)
+        await _history_append(session_id, "user", request.message)
+        await _history_append(session_id, "model", response_text)
+
+        return {"response": response_text}
     except Exception as e:
+        # Nothing persisted for a failed turn; drop the chat object — its
+        # internal history may be out of sync after a failed send
+        _chat_cache.pop(session_id, None)
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-def get_forum_context(db: Session, limit: int = 10) -> str:
-    questions = db.query(models.Question).order_by(models.Question.created_at.desc()).limit(limit).all()
-    if not questions:
-        return "No questions in the forum yet."
-    
-    context_lines = []
-    for q in questions:
-        # Simple format
-        status = "Resolved" if getattr(q, "resolved", False) else "Open"
-        line = f"QID:{q.id} Status:{status} Author:{q.author} Content:{q.content} (Tags: {', '.join(q.tags) if q.tags else 'None'})"
-        context_lines.append(line)
-    
-    return "\n".join(context_lines)
-
-@app.post("/lecturer/insight")
-async def get_lecturer_insight(request: InsightRequest, db: Session = Depends(get_db)):
+@app.post("/chat/stream")
+async def chat_with_ai_stream(request: ChatRequest, db: AsyncSession = Depends(get_db)):
+    """SSE variant of /chat: chunks arrive as they are generated, so perceived
+    latency is time-to-first-token instead of full generation time."""
     if client is None:
         raise HTTPException(status_code=503, detail="GEMINI_API_KEY not set")
 
     session_id = request.session_id
+    gemini_history, chat_input, forum_context = await _build_chat_prompt(db, session_id, request.message)
+    await db.commit()  # persist the session row if it was just created
+
+    # Free the pool slot before streaming; the final persist takes its own session
+    await db.close()
+
+    async def event_stream():
+        parts: list[str] = []
+        try:
+            # Hold the session lock for the whole stream: a second turn must
+            # not hit the same Chat object mid-generation
+            async with _chat_lock(session_id):
+                current_ctx = _forum_ctx_key(forum_context)
+                cached_chat = _chat_cache_get(session_id)
+                if cached_chat is not None:
+                    chat, chat_ctx = cached_chat
+                else:
+                    handle = await _get_forum_cache_handle(forum_context)
+                    if handle is not None:
+                        chat_ctx = current_ctx
+                        chat = client.chats.create(
+                            model=MODEL_NAME,
+                            history=gemini_history,
+                            config=genai_types.GenerateContentConfig(cached_content=handle.name),
+                        )
+                    else:
+                        chat_ctx = None
+                        chat = client.chats.create(
+                            model=MODEL_NAME, history=gemini_history, config=_STUDENT_CHAT_CONFIG
+                        )
+                if chat_ctx is not None and chat_ctx == current_ctx:
+                    send_text = f"User Query: {request.message}"
+                else:
+                    send_text = chat_input
+                async for chunk in _stream_in_thread(chat.send_message_stream(send_text)):
+                    if chunk.text:
+                        parts.append(chunk.text)
+                        yield f"data: {json.dumps({'delta': chunk.text})}\n\n"
+                _chat_cache_put(session_id, chat, chat_ctx)
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            _chat_cache.pop(session_id, None)
+            import traceback
+            traceback.print_exc()
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # Persist whatever was generated once the stream closes
+            full = "".join(parts)
+            if full:
+                _enqueue_chat_turn(session_id, request.message, full)
+                await _history_append(session_id, "user", request.message)
+                await _history_append(session_id, "model", full)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+async def get_forum_context(db: AsyncSession, limit: int = 10) -> str:
+    key = (limit, _forum_version)
+    cached = _forum_ctx_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < _FORUM_CTX_TTL:
+        return cached[1]
+
+    questions = (
+        await db.execute(
+            select(models.Question).order_by(models.Question.created_at.desc()).limit(limit)
+        )
+    ).scalars().all()
+    if not questions:
+        rendered = "No questions in the forum yet."
+    else:
+        context_lines = []
+        for q in questions:
+            # Simple format
+            status = "Resolved" if getattr(q, "resolved", False) else "Open"
+            line = f"QID:{q.id} Status:{status} Author:{q.author} Content:{q.content} (Tags: {', '.join(q.tags) if q.tags else 'None'})"
+            context_lines.append(line)
+        rendered = "\n".join(context_lines)
+
+    _forum_ctx_cache[key] = (time.monotonic(), rendered)
+    _forum_ctx_cache.move_to_end(key)
+    while len(_forum_ctx_cache) > _FORUM_CTX_MAX:
+        _forum_ctx_cache.popitem(last=False)
+    return rendered
+
+async def _build_insight_prompt(db: AsyncSession, session_id: str, query: str) -> tuple[list[dict], str]:
+    """Persist the lecturer's query and assemble the insight prompt.
+
+    Commits the session-if-missing insert plus the lecturer message, then
+    gathers the data sources and returns (gemini_history, chat_input).
+    """
+    # Ensure the session row exists — race-free do-nothing UPSERT (executed
+    # immediately, so the message insert below satisfies the FK)
+    await db.execute(
+        sqlite_insert(models.ChatSession)
+        .values(session_id=session_id, role="lecturer")
+        .on_conflict_do_nothing(index_elements=["session_id"])
+    )
 
-    # Check if session exists, create if not
-    db_session = db.query(models.ChatSession).filter(models.ChatSession.session_id == session_id).first()
-    if not db_session:
-        db_session = models.ChatSession(session_id=session_id, role="lecturer")
-        db.add(db_session)
-        db.commit()
-
-    # 1. Save Lecturer Message
-    lecturer_msg = models.ChatMessage(session_id=session_id, role="user", content=request.query)
+    # 1. Save Lecturer Message — one commit (and one fsync) covers both the
+    # session-if-missing insert and the message
+    lecturer_msg = models.ChatMessage(session_id=session_id, role="user", content=query)
     db.add(lecturer_msg)
-    db.commit()
-
-    # 2. Retrieve Lecturer Chat History
-    history_msgs = db.query(models.ChatMessage).filter(models.ChatMessage.session_id == session_id).order_by(models.ChatMessage.id).all()
-
-    # 3. Retrieve Student Logs (Analysis Target)
-    # Exclude lecturer sessions from analysis!
-    student_logs = db.query(models.ChatMessage).join(models.ChatSession).filter(models.ChatSession.role == "student").order_by(models.ChatMessage.session_id, models.ChatMessage.id).all()
-    
-    student_log_text = ""
-    current_session = ""
-    for msg in student_logs:
-        if msg.session_id != current_session:
-            student_log_text += f"\n--- Student Session {msg.session_id} ---\n"
-            current_session = msg.session_id
-        student_log_text += f"{msg.role}: {msg.content}\n"
-
-    if not student_log_text:
-        student_log_text = "(No student chat logs available yet.)"
+    await db.commit()
+
+    # 2.-4. The lecturer history, student logs and forum context are
+    # independent reads, so they run concurrently — each on its own session
+    # (an AsyncSession is not safe for concurrent use). Wall-clock cost drops
+    # to the slowest of the three instead of their sum.
+    async def _fetch_history() -> list:
+        # Most recent turns only, like /chat; an unbounded fetch grows (and
+        # costs Gemini tokens) with every query made
+        async with database.SessionLocal() as s:
+            rows = (
+                await s.execute(
+                    select(models.ChatMessage)
+                    .where(models.ChatMessage.session_id == session_id)
+                    .order_by(models.ChatMessage.id.desc())
+                    .limit(20)
+                )
+            ).scalars().all()
+            return list(reversed(rows))
+
+    async def _fetch_student_log_text() -> str:
+        # Analysis target; excludes lecturer sessions! Capped to the most
+        # recent messages — an unbounded fetch grows with every chat turn ever
+        # made and would eventually blow the model's context window. The
+        # per-session blocks are concatenated by SQLite's GROUP_CONCAT, so one
+        # row per session crosses the wire instead of one per message.
+        global _student_logs_memo
+        version = _logs_version
+        if _student_logs_memo is not None and _student_logs_memo[0] == version:
+            return _student_logs_memo[1]
+        recent_logs = (
+            select(models.ChatMessage.id, models.ChatMessage.session_id,
+                   models.ChatMessage.role, models.ChatMessage.content)
+            .join(models.ChatSession, models.ChatMessage.session_id == models.ChatSession.session_id)
+            .where(models.ChatSession.role == "student")
+            .order_by(models.ChatMessage.id.desc())
+            .limit(INSIGHT_LOG_LIMIT)
+            .subquery()
+        )
+        # Re-sort the window ascending before aggregating so each block reads
+        # in conversation order
+        ordered_logs = select(recent_logs).order_by(recent_logs.c.id).subquery()
+        async with database.SessionLocal() as s:
+            log_rows = (
+                await s.execute(
+                    select(
+                        ordered_logs.c.session_id,
+                        func.group_concat(
+                            ordered_logs.c.role.concat(": ").concat(ordered_logs.c.content), "\n"
+                        ),
+                    )
+                    .group_by(ordered_logs.c.session_id)
+                    .order_by(ordered_logs.c.session_id)
+                )
+            ).all()
+        text = "".join(
+            f"\n--- Student Session {sid} ---\n{block}\n" for sid, block in log_rows
+        )
+        _student_logs_memo = (version, text)
+        return text
 
-    # 4. Retrieve Forum Context
-    forum_context = get_forum_context(db, limit=20)
+    async def _fetch_forum_context() -> str:
+        async with database.SessionLocal() as s:
+            return await get_forum_context(s, limit=20)
 
-    # 5. Construct System/Context Prompt
-    prompt_context = f"""
-    You are a university lecturer's intelligent assistant "Class AI" for Insight Analysis.
-    
-    Your goal is to help the lecturer understand how students are doing based on two data sources:
-    1. Student Chat Logs (Private 1:1 sessions with AI)
-    2. Class Forum (Public questions posted by students)
+    history_msgs, student_log_text, forum_context = await asyncio.gather(
+        _fetch_history(), _fetch_student_log_text(), _fetch_forum_context()
+    )
 
-    [PRIVACY]: Do NOT quote specific messages or IDs unless necessary for context.
-    Summarize trends, confusion points, and suggest actions.
-    Answer in Japanese.
+    if not student_log_text:
+        student_log_text = "(No student chat logs available yet.)"
 
-    === Class Data Sources ===
-    
-    [Source A: Student Chat Logs]
-    {student_log_text}
-    
-    [Source B: Forum Questions]
-    {forum_context}
-    
-    ==========================
-    """
-    
-    # Construct Chat Input (Context + User Query)
-    chat_input = f"{prompt_context}\n\nLecturer Query: {request.query}"
+    # 5. Construct Chat Input (Context + User Query): dynamic snippets joined
+    # between the hoisted template constants
+    chat_input = "".join((
+        _INSIGHT_PROMPT_HEAD, student_log_text,
+        _INSIGHT_PROMPT_MID, forum_context,
+        _INSIGHT_PROMPT_TAIL, query,
+    ))
 
     # 6. Build Gemini History
     gemini_history = []
-    # Exclude the latest message (request.query) which is in chat_input
+    # Exclude the latest message (the query) which is in chat_input
     for msg in history_msgs[:-1]:
          gemini_history.append({"role": "user" if msg.role == "user" else "model", "parts": [{"text": msg.content}]})
-    
+
+    return gemini_history, chat_input
+
+async def _persist_insight_response(session_id: str, model_text: str) -> None:
+    """Save the model's insight reply on a fresh session (request scope may be gone)."""
+    async with database.SessionLocal() as s:
+        s.add(models.ChatMessage(session_id=session_id, role="model", content=model_text))
+        await s.commit()
+
+async def _persist_insight_turn(db: AsyncSession, session_id: str, query: str, model_text: str) -> None:
+    """Save a cache-served insight turn (query + reply) in one transaction.
+
+    Used when the cached answer short-circuits _build_insight_prompt, which
+    normally handles the session-if-missing insert and the query write.
+    """
+    # Race-free session-if-missing insert, executed ahead of the messages so
+    # the FK is satisfied
+    await db.execute(
+        sqlite_insert(models.ChatSession)
+        .values(session_id=session_id, role="lecturer")
+        .on_conflict_do_nothing(index_elements=["session_id"])
+    )
+    db.add(models.ChatMessage(session_id=session_id, role="user", content=query))
+    db.add(models.ChatMessage(session_id=session_id, role="model", content=model_text))
+    await db.commit()
+
+@app.post("/lecturer/insight")
+async def get_lecturer_insight(request: InsightRequest, db: AsyncSession = Depends(get_db)):
+    if client is None:
+        raise HTTPException(status_code=503, detail="GEMINI_API_KEY not set")
+
+    session_id = request.session_id
+
+    # Version-keyed hit: same query while logs and forum are unchanged —
+    # skips the prompt assembly (and its aggregation queries) entirely
+    insight_key = _insight_cache_key(session_id, request.query)
+    response_text = _llm_cache_get(insight_key)
+    if response_text is not None:
+        await _persist_insight_turn(db, session_id, request.query, response_text)
+        return {"response": response_text}
+
+    gemini_history, chat_input = await _build_insight_prompt(db, session_id, request.query)
+
     try:
-        chat = client.chats.create(
-            model=MODEL_NAME,
-            history=gemini_history
-        )
-        response = chat.send_message(chat_input)
-        
+        # Exact cache hit (e.g. a repeated dashboard refresh with unchanged logs)
+        cache_key = _llm_cache_key(MODEL_NAME, json.dumps(gemini_history), chat_input)
+        response_text = _llm_cache_get(cache_key)
+
+        if response_text is None:
+            chat = client.chats.create(
+                model=MODEL_NAME,
+                history=gemini_history
+            )
+            response = await _gemini_call(lambda: chat.send_message(chat_input))
+            response_text = response.text
+            _llm_cache_put(cache_key, response_text)
+            _llm_cache_put(insight_key, response_text)
+
         # 7. Save Model Response
-        model_msg = models.ChatMessage(session_id=session_id, role="model", content=response.text)
+        model_msg = models.ChatMessage(session_id=session_id, role="model", content=response_text)
         db.add(model_msg)
-        db.commit()
-        
-        return {"response": response.text}
+        await db.commit()
+
+        return {"response": response_text}
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/lecturer/insight/stream")
+async def get_lecturer_insight_stream(request: InsightRequest, db: AsyncSession = Depends(get_db)):
+    """SSE variant of /lecturer/insight, mirroring /chat/stream: the analysis
+    starts rendering at first-token time instead of after full generation."""
+    if client is None:
+        raise HTTPException(status_code=503, detail="GEMINI_API_KEY not set")
+
+    session_id = request.session_id
+
+    # Version-keyed hit: replay the cached answer as a single delta event
+    insight_key = _insight_cache_key(session_id, request.query)
+    cached_text = _llm_cache_get(insight_key)
+    if cached_text is not None:
+        await _persist_insight_turn(db, session_id, request.query, cached_text)
+
+        async def replay_stream():
+            yield f"data: {json.dumps({'delta': cached_text})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(replay_stream(), media_type="text/event-stream")
+
+    gemini_history, chat_input = await _build_insight_prompt(db, session_id, request.query)
+
+    # Free the pool slot before streaming; the final persist takes its own session
+    await db.close()
+
+    async def event_stream():
+        parts: list[str] = []
+        try:
+            chat = client.chats.create(model=MODEL_NAME, history=gemini_history)
+            async for chunk in _stream_in_thread(chat.send_message_stream(chat_input)):
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield f"data: {json.dumps({'delta': chunk.text})}\n\n"
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # Persist whatever was generated once the stream closes
+            full = "".join(parts)
+            if full:
+                _llm_cache_put(insight_key, full)
+                await _persist_insight_response(session_id, full)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 # Forum Endpoints
-@app.get("/questions", response_model=list[QuestionResponse])
-def get_questions(username: str | None = None, db: Session = Depends(get_db)):
-    questions = db.query(models.Question).order_by(models.Question.created_at.desc()).all()
-    
+# No response_model: the dicts below are built to shape already, so Pydantic
+# re-validation on this hot list endpoint is pure overhead. The OpenAPI schema
+# is kept via `responses`.
+@app.get("/questions", responses={200: {"model": list[QuestionResponse]}})
+async def get_questions(username: str | None = None, db: AsyncSession = Depends(get_db)):
+    questions = (
+        await db.execute(select(models.Question).order_by(models.Question.created_at.desc()))
+    ).scalars().all()
+
     # Get user if username provided
     user_id = None
     if username:
-        user = db.query(models.User).filter(models.User.username == username).first()
+        user = (await db.execute(_USER_BY_NAME, {"username": username})).scalars().first()
         if user:
             user_id = user.id
 
+    # Aggregate reaction counts in one GROUP BY query instead of one SELECT per question (N+1)
+    reaction_counts_by_q: dict[int, dict[str, int]] = {}
+    count_rows = (
+        await db.execute(
+            select(models.QuestionReaction.question_id, models.QuestionReaction.reaction_type, func.count())
+            .group_by(models.QuestionReaction.question_id, models.QuestionReaction.reaction_type)
+        )
+    ).all()
+    for qid, rtype, cnt in count_rows:
+        reaction_counts_by_q.setdefault(qid, {})[rtype] = cnt
+
+    # One query for the current user's own reactions
+    user_reaction_by_q: dict[int, str] = {}
+    if user_id:
+        user_reaction_by_q = dict(
+            (
+                await db.execute(
+                    select(models.QuestionReaction.question_id, models.QuestionReaction.reaction_type)
+                    .where(models.QuestionReaction.user_id == user_id)
+                )
+            ).all()
+        )
+
+    # Comment counts likewise in one GROUP BY query instead of one per question
+    comment_count_by_q = dict(
+        (
+            await db.execute(
+                select(models.QuestionComment.question_id, func.count())
+                .group_by(models.QuestionComment.question_id)
+            )
+        ).all()
+    )
+
     result = []
     for q in questions:
-        # Count reactions
-        # This is N+1 query problem potential but fine for prototype scale
-        reactions_query = db.query(models.QuestionReaction).filter(models.QuestionReaction.question_id == q.id).all()
-        comment_count = db.query(models.QuestionComment).filter(models.QuestionComment.question_id == q.id).count()
-        
-        reaction_counts = {}
-        user_reaction = None
-        
-        for r in reactions_query:
-            reaction_counts[r.reaction_type] = reaction_counts.get(r.reaction_type, 0) + 1
-            if user_id and r.user_id == user_id:
-                user_reaction = r.reaction_type
-        
         result.append({
             "id": q.id,
             "author": q.author,
@@ -377,33 +1382,42 @@ def get_questions(username: str | None = None, db: Session = Depends(get_db)):
             "tags": q.tags,
             "likes": q.likes,
             "resolved": q.resolved,
-            "reactions": reaction_counts,
-            "user_reaction": user_reaction,
-            "comment_count": comment_count,
+            "reactions": reaction_counts_by_q.get(q.id, {}),
+            "user_reaction": user_reaction_by_q.get(q.id),
+            "comment_count": comment_count_by_q.get(q.id, 0),
         })
     return result
 
-@app.get("/questions/{question_id}", response_model=QuestionResponse)
-def get_question(question_id: int, username: str | None = None, db: Session = Depends(get_db)):
-    q = db.query(models.Question).filter(models.Question.id == question_id).first()
-    if not q:
-        raise HTTPException(status_code=404, detail="Question not found")
+async def _question_with_meta(db: AsyncSession, q: models.Question, username: str | None) -> dict:
+    """Fold reactions and comment count for one (already loaded) question.
 
+    Shared by the single-question read and the mutation read-backs, which all
+    shape the same QuestionResponse dict.
+    """
     user_id = None
     if username:
-        user = db.query(models.User).filter(models.User.username == username).first()
+        user = (await db.execute(_USER_BY_NAME, {"username": username})).scalars().first()
         if user:
             user_id = user.id
 
-    reactions_query = db.query(models.QuestionReaction).filter(models.QuestionReaction.question_id == q.id).all()
-    comment_count = db.query(models.QuestionComment).filter(models.QuestionComment.question_id == q.id).count()
+    reaction_rows = (
+        await db.execute(
+            select(models.QuestionReaction.reaction_type, models.QuestionReaction.user_id)
+            .where(models.QuestionReaction.question_id == q.id)
+        )
+    ).all()
+    comment_count = (
+        await db.execute(
+            select(func.count(models.QuestionComment.id)).where(models.QuestionComment.question_id == q.id)
+        )
+    ).scalar()
 
     reaction_counts: dict[str, int] = {}
     user_reaction: str | None = None
-    for r in reactions_query:
-        reaction_counts[r.reaction_type] = reaction_counts.get(r.reaction_type, 0) + 1
-        if user_id and r.user_id == user_id:
-            user_reaction = r.reaction_type
+    for rtype, uid in reaction_rows:
+        reaction_counts[rtype] = reaction_counts.get(rtype, 0) + 1
+        if user_id and uid == user_id:
+            user_reaction = rtype
 
     return {
         "id": q.id,
@@ -417,16 +1431,24 @@ def get_question(question_id: int, username: str | None = None, db: Session = De
         "comment_count": comment_count,
     }
 
+@app.get("/questions/{question_id}", responses={200: {"model": QuestionResponse}})
+async def get_question(question_id: int, username: str | None = None, db: AsyncSession = Depends(get_db)):
+    q = (await db.execute(_Q_BY_ID, {"qid": question_id})).scalars().first()
+    if not q:
+        raise HTTPException(status_code=404, detail="Question not found")
+    return await _question_with_meta(db, q, username)
+
 @app.post("/questions", response_model=QuestionResponse)
-def create_question(question: QuestionCreate, db: Session = Depends(get_db)):
+async def create_question(question: QuestionCreate, db: AsyncSession = Depends(get_db)):
     db_question = models.Question(
         author=question.author,
         content=question.content,
         tags=question.tags
     )
     db.add(db_question)
-    db.commit()
-    db.refresh(db_question)
+    await db.commit()
+    await db.refresh(db_question)
+    _invalidate_forum_context()
     return {
         "id": db_question.id,
         "author": db_question.author,
@@ -440,46 +1462,25 @@ def create_question(question: QuestionCreate, db: Session = Depends(get_db)):
     }
 
 @app.put("/questions/{question_id}/resolve", response_model=QuestionResponse)
-def resolve_question(question_id: int, payload: QuestionResolveRequest, db: Session = Depends(get_db)):
+async def resolve_question(question_id: int, payload: QuestionResolveRequest, db: AsyncSession = Depends(get_db)):
     username = payload.username.strip()
     if not username:
         raise HTTPException(status_code=400, detail="Username cannot be empty")
 
-    q = db.query(models.Question).filter(models.Question.id == question_id).first()
+    q = (await db.execute(_Q_BY_ID, {"qid": question_id})).scalars().first()
     if not q:
         raise HTTPException(status_code=404, detail="Question not found")
     if q.author != username:
         raise HTTPException(status_code=403, detail="You can only resolve your own posts")
 
     q.resolved = bool(payload.resolved)
-    db.commit()
+    await db.commit()
+    _invalidate_forum_context()
 
-    user = db.query(models.User).filter(models.User.username == username).first()
-    user_id = user.id if user else None
-    reactions_query = db.query(models.QuestionReaction).filter(models.QuestionReaction.question_id == q.id).all()
-    comment_count = db.query(models.QuestionComment).filter(models.QuestionComment.question_id == q.id).count()
-
-    reaction_counts: dict[str, int] = {}
-    user_reaction: str | None = None
-    for r in reactions_query:
-        reaction_counts[r.reaction_type] = reaction_counts.get(r.reaction_type, 0) + 1
-        if user_id and r.user_id == user_id:
-            user_reaction = r.reaction_type
-
-    return {
-        "id": q.id,
-        "author": q.author,
-        "content": q.content,
-        "tags": q.tags,
-        "likes": q.likes,
-        "resolved": q.resolved,
-        "reactions": reaction_counts,
-        "user_reaction": user_reaction,
-        "comment_count": comment_count,
-    }
+    return await _question_with_meta(db, q, username)
 
 @app.put("/questions/{question_id}", response_model=QuestionResponse)
-def update_question(question_id: int, payload: QuestionUpdate, db: Session = Depends(get_db)):
+async def update_question(question_id: int, payload: QuestionUpdate, db: AsyncSession = Depends(get_db)):
     username = payload.username.strip()
     content = payload.content.strip()
     if not username:
@@ -487,7 +1488,7 @@ def update_question(question_id: int, payload: QuestionUpdate, db: Session = Dep
     if not content:
         raise HTTPException(status_code=400, detail="Content cannot be empty")
 
-    q = db.query(models.Question).filter(models.Question.id == question_id).first()
+    q = (await db.execute(_Q_BY_ID, {"qid": question_id})).scalars().first()
     if not q:
         raise HTTPException(status_code=404, detail="Question not found")
     if q.author != username:
@@ -496,44 +1497,23 @@ def update_question(question_id: int, payload: QuestionUpdate, db: Session = Dep
     q.content = content
     if payload.tags is not None:
         q.tags = payload.tags
-    db.commit()
-
-    user = db.query(models.User).filter(models.User.username == username).first()
-    user_id = user.id if user else None
-    reactions_query = db.query(models.QuestionReaction).filter(models.QuestionReaction.question_id == q.id).all()
-    comment_count = db.query(models.QuestionComment).filter(models.QuestionComment.question_id == q.id).count()
+    await db.commit()
+    _invalidate_forum_context()
 
-    reaction_counts: dict[str, int] = {}
-    user_reaction: str | None = None
-    for r in reactions_query:
-        reaction_counts[r.reaction_type] = reaction_counts.get(r.reaction_type, 0) + 1
-        if user_id and r.user_id == user_id:
-            user_reaction = r.reaction_type
-
-    return {
-        "id": q.id,
-        "author": q.author,
-        "content": q.content,
-        "tags": q.tags,
-        "likes": q.likes,
-        "resolved": q.resolved,
-        "reactions": reaction_counts,
-        "user_reaction": user_reaction,
-        "comment_count": comment_count,
-    }
+    return await _question_with_meta(db, q, username)
 
 @app.delete("/questions/{question_id}")
-def delete_question(
+async def delete_question(
     question_id: int,
     username: str,
     role: str = "student",
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     username = username.strip()
     if not username:
         raise HTTPException(status_code=400, detail="Username cannot be empty")
 
-    q = db.query(models.Question).filter(models.Question.id == question_id).first()
+    q = (await db.execute(_Q_BY_ID, {"qid": question_id})).scalars().first()
     if not q:
         raise HTTPException(status_code=404, detail="Question not found")
 
@@ -541,58 +1521,76 @@ def delete_question(
     if (not is_lecturer) and (q.author != username):
         raise HTTPException(status_code=403, detail="You can only delete your own posts")
 
-    db.query(models.QuestionReaction).filter(models.QuestionReaction.question_id == question_id).delete(synchronize_session=False)
-    comment_ids = [cid for (cid,) in db.query(models.QuestionComment.id).filter(models.QuestionComment.question_id == question_id).all()]
-    if comment_ids:
-        db.query(models.CommentReaction).filter(models.CommentReaction.comment_id.in_(comment_ids)).delete(synchronize_session=False)
-    db.query(models.QuestionComment).filter(models.QuestionComment.question_id == question_id).delete(synchronize_session=False)
-    db.delete(q)
-    db.commit()
+    # ON DELETE CASCADE handles reactions and comments in the DB
+    await db.delete(q)
+    await db.commit()
+    _invalidate_forum_context()
     return {"status": "deleted"}
 
-@app.get("/questions/{question_id}/comments", response_model=list[CommentResponse])
-def get_comments(question_id: int, username: str | None = None, db: Session = Depends(get_db)):
-    exists = db.query(models.Question).filter(models.Question.id == question_id).first()
+# Same trusted-dict bypass as /questions: the rows are already response-shaped
+@app.get("/questions/{question_id}/comments", responses={200: {"model": list[CommentResponse]}})
+async def get_comments(question_id: int, username: str | None = None, db: AsyncSession = Depends(get_db)):
+    exists = (await db.execute(select(models.Question.id).where(models.Question.id == question_id))).first()
     if not exists:
         raise HTTPException(status_code=404, detail="Question not found")
 
     user_id = None
     if username:
-        user = db.query(models.User).filter(models.User.username == username).first()
+        user = (await db.execute(_USER_BY_NAME, {"username": username})).scalars().first()
         if user:
             user_id = user.id
 
     comments = (
-        db.query(models.QuestionComment)
-        .filter(models.QuestionComment.question_id == question_id)
-        .order_by(models.QuestionComment.created_at.asc(), models.QuestionComment.id.asc())
-        .all()
-    )
+        await db.execute(
+            select(models.QuestionComment)
+            .where(models.QuestionComment.question_id == question_id)
+            .order_by(models.QuestionComment.created_at.asc(), models.QuestionComment.id.asc())
+        )
+    ).scalars().all()
+
+    # Batch the reaction lookups instead of one query per comment (N+1)
+    cids = [c.id for c in comments]
+    reaction_counts_by_c: dict[int, dict[str, int]] = {}
+    user_reaction_by_c: dict[int, str] = {}
+    if cids:
+        count_rows = (
+            await db.execute(
+                select(models.CommentReaction.comment_id, models.CommentReaction.reaction_type, func.count())
+                .where(models.CommentReaction.comment_id.in_(cids))
+                .group_by(models.CommentReaction.comment_id, models.CommentReaction.reaction_type)
+            )
+        ).all()
+        for cid, rtype, cnt in count_rows:
+            reaction_counts_by_c.setdefault(cid, {})[rtype] = cnt
+        if user_id:
+            user_reaction_by_c = dict(
+                (
+                    await db.execute(
+                        select(models.CommentReaction.comment_id, models.CommentReaction.reaction_type)
+                        .where(
+                            models.CommentReaction.comment_id.in_(cids),
+                            models.CommentReaction.user_id == user_id,
+                        )
+                    )
+                ).all()
+            )
 
     result = []
     for c in comments:
-        reactions_query = db.query(models.CommentReaction).filter(models.CommentReaction.comment_id == c.id).all()
-        reaction_counts: dict[str, int] = {}
-        user_reaction: str | None = None
-        for r in reactions_query:
-            reaction_counts[r.reaction_type] = reaction_counts.get(r.reaction_type, 0) + 1
-            if user_id and r.user_id == user_id:
-                user_reaction = r.reaction_type
-
         result.append({
             "id": c.id,
             "question_id": c.question_id,
             "author": c.author,
             "content": c.content,
             "created_at": c.created_at,
-            "reactions": reaction_counts,
-            "user_reaction": user_reaction,
+            "reactions": reaction_counts_by_c.get(c.id, {}),
+            "user_reaction": user_reaction_by_c.get(c.id),
         })
 
     return result
 
 @app.post("/questions/{question_id}/comments", response_model=CommentResponse)
-def create_comment(question_id: int, comment: CommentCreate, db: Session = Depends(get_db)):
+async def create_comment(question_id: int, comment: CommentCreate, db: AsyncSession = Depends(get_db)):
     author = comment.author.strip()
     content = comment.content.strip()
     if not author:
@@ -600,14 +1598,14 @@ def create_comment(question_id: int, comment: CommentCreate, db: Session = Depen
     if not content:
         raise HTTPException(status_code=400, detail="Content cannot be empty")
 
-    q = db.query(models.Question).filter(models.Question.id == question_id).first()
+    q = (await db.execute(select(models.Question.id).where(models.Question.id == question_id))).first()
     if not q:
         raise HTTPException(status_code=404, detail="Question not found")
 
     db_comment = models.QuestionComment(question_id=question_id, author=author, content=content)
     db.add(db_comment)
-    db.commit()
-    db.refresh(db_comment)
+    await db.commit()
+    await db.refresh(db_comment)
     return {
         "id": db_comment.id,
         "question_id": db_comment.question_id,
@@ -619,7 +1617,7 @@ def create_comment(question_id: int, comment: CommentCreate, db: Session = Depen
     }
 
 @app.put("/comments/{comment_id}", response_model=CommentResponse)
-def update_comment(comment_id: int, payload: CommentUpdate, db: Session = Depends(get_db)):
+async def update_comment(comment_id: int, payload: CommentUpdate, db: AsyncSession = Depends(get_db)):
     username = payload.username.strip()
     content = payload.content.strip()
     if not username:
@@ -627,18 +1625,20 @@ def update_comment(comment_id: int, payload: CommentUpdate, db: Session = Depend
     if not content:
         raise HTTPException(status_code=400, detail="Content cannot be empty")
 
-    c = db.query(models.QuestionComment).filter(models.QuestionComment.id == comment_id).first()
+    c = (await db.execute(select(models.QuestionComment).where(models.QuestionComment.id == comment_id))).scalars().first()
     if not c:
         raise HTTPException(status_code=404, detail="Comment not found")
     if c.author != username:
         raise HTTPException(status_code=403, detail="You can only edit your own comments")
 
     c.content = content
-    db.commit()
+    await db.commit()
 
-    user = db.query(models.User).filter(models.User.username == username).first()
+    user = (await db.execute(_USER_BY_NAME, {"username": username})).scalars().first()
     user_id = user.id if user else None
-    reactions_query = db.query(models.CommentReaction).filter(models.CommentReaction.comment_id == c.id).all()
+    reactions_query = (
+        await db.execute(select(models.CommentReaction).where(models.CommentReaction.comment_id == c.id))
+    ).scalars().all()
     reaction_counts: dict[str, int] = {}
     user_reaction: str | None = None
     for r in reactions_query:
@@ -657,17 +1657,17 @@ def update_comment(comment_id: int, payload: CommentUpdate, db: Session = Depend
     }
 
 @app.delete("/comments/{comment_id}")
-def delete_comment(
+async def delete_comment(
     comment_id: int,
     username: str,
     role: str = "student",
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     username = username.strip()
     if not username:
         raise HTTPException(status_code=400, detail="Username cannot be empty")
 
-    c = db.query(models.QuestionComment).filter(models.QuestionComment.id == comment_id).first()
+    c = (await db.execute(select(models.QuestionComment).where(models.QuestionComment.id == comment_id))).scalars().first()
     if not c:
         raise HTTPException(status_code=404, detail="Comment not found")
 
@@ -675,82 +1675,99 @@ def delete_comment(
     if (not is_lecturer) and (c.author != username):
         raise HTTPException(status_code=403, detail="You can only delete your own comments")
 
-    db.query(models.CommentReaction).filter(models.CommentReaction.comment_id == comment_id).delete(synchronize_session=False)
-    db.delete(c)
-    db.commit()
+    await db.execute(delete(models.CommentReaction).where(models.CommentReaction.comment_id == comment_id))
+    await db.delete(c)
+    await db.commit()
     return {"status": "deleted"}
 
 @app.post("/comments/{comment_id}/react")
-def react_to_comment(comment_id: int, req: ReactionRequest, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == req.username).first()
-    if not user:
-        user = models.User(username=req.username)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-
-    comment = db.query(models.QuestionComment).filter(models.QuestionComment.id == comment_id).first()
+async def react_to_comment(comment_id: int, req: ReactionRequest, db: AsyncSession = Depends(get_db)):
+    user = await _upsert_user(db, req.username)
+
+    comment = (await db.execute(select(models.QuestionComment.id).where(models.QuestionComment.id == comment_id))).first()
     if not comment:
+        await db.rollback()
         raise HTTPException(status_code=404, detail="Comment not found")
 
-    existing = db.query(models.CommentReaction).filter(
-        models.CommentReaction.comment_id == comment_id,
-        models.CommentReaction.user_id == user.id
-    ).first()
-
-    if existing:
-        if existing.reaction_type == req.reaction_type:
-            db.delete(existing)
-            db.commit()
-            return {"status": "removed"}
-        else:
-            existing.reaction_type = req.reaction_type
-            db.commit()
-            return {"status": "updated"}
-    else:
-        new_reaction = models.CommentReaction(
-            comment_id=comment_id,
-            user_id=user.id,
-            reaction_type=req.reaction_type
+    # Same atomic toggle/set scheme as question reactions, backed by the
+    # UNIQUE (comment_id, user_id) constraint
+    prior = (
+        await db.execute(
+            select(models.CommentReaction.reaction_type).where(
+                models.CommentReaction.comment_id == comment_id,
+                models.CommentReaction.user_id == user.id,
+            )
         )
-        db.add(new_reaction)
-        db.commit()
-        return {"status": "added"}
+    ).scalar()
+
+    if prior == req.reaction_type:
+        # Toggle off
+        await db.execute(
+            delete(models.CommentReaction).where(
+                models.CommentReaction.comment_id == comment_id,
+                models.CommentReaction.user_id == user.id,
+                models.CommentReaction.reaction_type == req.reaction_type,
+            )
+        )
+        await db.commit()
+        return {"status": "removed"}
+
+    stmt = sqlite_insert(models.CommentReaction).values(
+        comment_id=comment_id,
+        user_id=user.id,
+        reaction_type=req.reaction_type,
+    ).on_conflict_do_update(
+        index_elements=["comment_id", "user_id"],
+        set_={"reaction_type": req.reaction_type},
+    )
+    await db.execute(stmt)
+    await db.commit()
+    return {"status": "updated" if prior else "added"}
 
 @app.post("/questions/{question_id}/react")
-def react_to_question(question_id: int, req: ReactionRequest, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == req.username).first()
-    if not user:
-         # Auto-create user if not exists (Robustness for prototype)
-         user = models.User(username=req.username)
-         db.add(user)
-         db.commit()
-         db.refresh(user)
-
-    # Check existing reaction
-    existing = db.query(models.QuestionReaction).filter(
-        models.QuestionReaction.question_id == question_id,
-        models.QuestionReaction.user_id == user.id
-    ).first()
-
-    if existing:
-        if existing.reaction_type == req.reaction_type:
-            # Toggle off
-            db.delete(existing)
-            db.commit()
-            return {"status": "removed"}
-        else:
-            # Change reaction
-            existing.reaction_type = req.reaction_type
-            db.commit()
-            return {"status": "updated"}
-    else:
-        # Create new
-        new_reaction = models.QuestionReaction(
-             question_id=question_id,
-             user_id=user.id,
-             reaction_type=req.reaction_type
+async def react_to_question(question_id: int, req: ReactionRequest, db: AsyncSession = Depends(get_db)):
+    # Auto-create user if not exists (robustness for prototype) — one UPSERT
+    # round trip instead of select-then-insert
+    user = await _upsert_user(db, req.username)
+
+    question = (await db.execute(select(models.Question.id).where(models.Question.id == question_id))).first()
+    if not question:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="Question not found")
+
+    # Toggle off / set via atomic statements: the UNIQUE (question_id, user_id)
+    # constraint makes concurrent double-clicks race-free (no duplicate rows,
+    # no duplicate-key errors)
+    prior = (
+        await db.execute(
+            select(models.QuestionReaction.reaction_type).where(
+                models.QuestionReaction.question_id == question_id,
+                models.QuestionReaction.user_id == user.id,
+            )
         )
-        db.add(new_reaction)
-        db.commit()
-        return {"status": "added"}
+    ).scalar()
+
+    if prior == req.reaction_type:
+        # Toggle off
+        await db.execute(
+            delete(models.QuestionReaction).where(
+                models.QuestionReaction.question_id == question_id,
+                models.QuestionReaction.user_id == user.id,
+                models.QuestionReaction.reaction_type == req.reaction_type,
+            )
+        )
+        await db.commit()
+        return {"status": "removed"}
+
+    # Create or change in one UPSERT
+    stmt = sqlite_insert(models.QuestionReaction).values(
+        question_id=question_id,
+        user_id=user.id,
+        reaction_type=req.reaction_type,
+    ).on_conflict_do_update(
+        index_elements=["question_id", "user_id"],
+        set_={"reaction_type": req.reaction_type},
+    )
+    await db.execute(stmt)
+    await db.commit()
+    return {"status": "updated" if prior else "added"}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, PickleType, Boolean
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 import datetime
 from database import Base
@@ -12,37 +12,64 @@ class User(Base):
 
 class Question(Base):
     __tablename__ = "questions"
+    # The list endpoint and forum context always order by created_at (SQLite
+    # walks the index backwards for DESC)
+    __table_args__ = (Index("ix_questions_created_at", "created_at"),)
 
     id = Column(Integer, primary_key=True, index=True)
     author = Column(String, default="Anonymous")
     content = Column(String)
-    tags = Column(PickleType, default=[]) 
+    # JSON text, not pickle: hydration goes through C json instead of
+    # Python-level unpickling, and the column stays queryable with json_each.
+    # default=list also fixes the shared-mutable-default of the old default=[]
+    tags = Column(JSON, default=list)
     likes = Column(Integer, default=0) # Deprecated but kept for compatibility
     resolved = Column(Boolean, nullable=False, default=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+    # passive_deletes: deleting a question cascades in the DB (ON DELETE
+    # CASCADE) instead of the ORM loading and deleting children row by row
+    comments = relationship("QuestionComment", cascade="all, delete-orphan", passive_deletes=True)
+    reactions = relationship("QuestionReaction", cascade="all, delete-orphan", passive_deletes=True)
+
 class QuestionReaction(Base):
     __tablename__ = "question_reactions"
+    # One reaction per user per question; also backs upsert-style toggles.
+    # The covering index serves the GROUP BY fold without touching the heap.
+    __table_args__ = (
+        UniqueConstraint("question_id", "user_id", name="uq_question_reactions_question_user"),
+        Index("ix_question_reactions_qid_user_type", "question_id", "user_id", "reaction_type"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    question_id = Column(Integer, ForeignKey("questions.id"), index=True)
+    question_id = Column(Integer, ForeignKey("questions.id", ondelete="CASCADE"), index=True)
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
     reaction_type = Column(String) # like, insightful, curious, funny
 
 class QuestionComment(Base):
     __tablename__ = "question_comments"
+    # Matches the comment list's WHERE question_id + ORDER BY created_at, id
+    __table_args__ = (Index("ix_question_comments_qid_created_id", "question_id", "created_at", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
-    question_id = Column(Integer, ForeignKey("questions.id"), index=True)
+    question_id = Column(Integer, ForeignKey("questions.id", ondelete="CASCADE"), index=True)
     author = Column(String, default="Anonymous")
     content = Column(Text)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+    reactions = relationship("CommentReaction", cascade="all, delete-orphan", passive_deletes=True)
+
 class CommentReaction(Base):
     __tablename__ = "comment_reactions"
+    # One reaction per user per comment; also backs upsert-style toggles.
+    # Covering index, as on question_reactions.
+    __table_args__ = (
+        UniqueConstraint("comment_id", "user_id", name="uq_comment_reactions_comment_user"),
+        Index("ix_comment_reactions_cid_user_type", "comment_id", "user_id", "reaction_type"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    comment_id = Column(Integer, ForeignKey("question_comments.id"), index=True)
+    comment_id = Column(Integer, ForeignKey("question_comments.id", ondelete="CASCADE"), index=True)
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
     reaction_type = Column(String) # like, insightful, curious, funny
 
@@ -52,9 +79,16 @@ class ChatSession(Base):
     session_id = Column(String, primary_key=True, index=True)
     role = Column(String) # student, lecturer
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Rolling summary of turns that have slid out of the prompt window, so
+    # long sessions keep bounded input tokens without losing early context;
+    # summary_upto_id marks the last message the summary covers
+    summary = Column(Text, nullable=True)
+    summary_upto_id = Column(Integer, nullable=False, default=0)
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    # Every history lookup filters on session_id and orders by id
+    __table_args__ = (Index("ix_chat_messages_session_id_id", "session_id", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(String, ForeignKey("chat_sessions.session_id"))
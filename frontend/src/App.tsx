@@ -212,19 +212,49 @@ function LecturerInsightBoard({ user }: { user: User }) {
     setLoading(true);
 
     try {
-      const res = await fetch('/api/lecturer/insight', {
+      const res = await fetch('/api/lecturer/insight/stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ query: userMsg, session_id: sessionId }),
       });
-      const data = await res.json().catch(() => ({} as any));
-      if (!res.ok) {
+      if (!res.ok || !res.body) {
+        const data = await res.json().catch(() => ({} as any));
         throw new Error(data?.detail || `HTTP ${res.status}`);
       }
-      setMessages(prev => [...prev, { role: 'model', content: data.response ?? '', timestamp: new Date().toISOString() }]);
+
+      // Consume the SSE stream, growing the model message as deltas arrive
+      setMessages(prev => [...prev, { role: 'model', content: '', timestamp: new Date().toISOString() }]);
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let full = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop() ?? '';
+        for (const event of events) {
+          if (!event.startsWith('data: ')) continue;
+          const payload = event.slice(6);
+          if (payload === '[DONE]') continue;
+          const parsed = JSON.parse(payload);
+          if (parsed.error) throw new Error(parsed.error);
+          if (parsed.delta) {
+            full += parsed.delta;
+            const content = full;
+            setMessages(prev => prev.map((m, i) => i === prev.length - 1 ? { ...m, content } : m));
+          }
+        }
+      }
+      if (!full) throw new Error('empty response');
     } catch (err) {
       console.error(err);
-      setMessages(prev => [...prev, { role: 'model', content: 'エラー: インサイトを取得できませんでした。', timestamp: new Date().toISOString() }]);
+      setMessages(prev => {
+        // Drop a partially-streamed empty bubble before showing the error
+        const cleaned = prev.filter((m, i) => !(i === prev.length - 1 && m.role === 'model' && !m.content));
+        return [...cleaned, { role: 'model', content: 'エラー: インサイトを取得できませんでした。', timestamp: new Date().toISOString() }];
+      });
     } finally {
       setLoading(false);
     }